@@ -1,4 +1,3 @@
-import json
 import numpy as np
 import pandas as pd
 from bokeh.palettes import brewer
@@ -6,6 +5,8 @@ from bokeh.plotting import figure
 from bokeh.io import output_notebook, show, output_file
 from bokeh.models import GeoJSONDataSource, LinearColorMapper, ColorBar
 
+_notebook_initialized = False  # Bokeh resources only need to be loaded into the notebook once
+
 def get_yearly_disaster_count(df: pd.DataFrame, index_cols: list | None = None, include_zero: bool = True) -> pd.Series:
     """ Calculate number of disaster occurrences grouped by index_cols for each Start_Year.
 
@@ -29,13 +30,15 @@ def get_yearly_disaster_count(df: pd.DataFrame, index_cols: list | None = None,
 
     default_index = ["Start_Year"]
     index = index_cols if index_cols is not None else default_index
-    if not include_zero:
-        return df.groupby(index).size().rename("No_Disasters")
+    if index == default_index:
+        return df["Start_Year"].value_counts(sort=False).sort_index().rename("No_Disasters").rename_axis("Start_Year")
 
-    count_nonzero = get_yearly_disaster_count(df=df, index_cols=index_cols, include_zero=False)
-    if index != default_index:
-        return count_nonzero.unstack(fill_value=0).stack().rename("No_Disasters")
-    return count_nonzero
+    counts = df.groupby(index, sort=False, observed=True).size().rename("No_Disasters")
+    if include_zero and len(index) > 1:
+        counts_index = counts.index.remove_unused_levels()
+        complete_index = pd.MultiIndex.from_product([level.sort_values() for level in counts_index.levels], names=counts_index.names)
+        return counts.reindex(complete_index, fill_value=0)
+    return counts.sort_index()
 
 def get_yearly_pct_change_to_initial(df: pd.DataFrame, index_cols: list | None = None) -> pd.Series:
     """ Calculate yearly percentage change number of disaster occurrences compared to the average of the first 10 years, grouped by the respective column.
@@ -57,15 +60,39 @@ def get_yearly_pct_change_to_initial(df: pd.DataFrame, index_cols: list | None =
     """
     min_year = df["Start_Year"].min()
     counts: pd.Series = get_yearly_disaster_count(df=df, index_cols=index_cols, include_zero=True)
-    initial_average = counts.loc[min_year:min_year+10].groupby(level=1).mean()
     if index_cols is not None:
-        ret = counts.groupby(level=[1], group_keys=False).apply(lambda x: (x.div(initial_average, level=1) -1) *100).rename("Percent_Change")
+        initial_average = counts.loc[min_year:min_year+10].groupby(level=1).mean()
+        ret = counts.div(initial_average.reindex(counts.index, level=1))
     else:
-        percent_change = (count_nonzero.div(count_nonzero.iloc[0]) -1) *100
-        ret = percent_change.rename("Percent_Change")
-    ret.replace([np.inf, -np.inf], np.nan, inplace=True)
-    ret.dropna(inplace=True)
-    return ret
+        initial_average = counts.loc[min_year:min_year+10].mean()
+        ret = counts.div(initial_average)
+    # in-place to avoid a temporary series per operation
+    ret -= 1
+    ret *= 100
+    ret.name = "Percent_Change"
+    return ret.mask(np.isinf(ret)).dropna()
+
+
+def _expand_year_ranges(start_years: np.ndarray, durations: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Expand each disaster into one row per calendar year between its Start_Year and End_Year.
+
+    Parameters
+    ----------
+    start_years: np.ndarray
+        The Start_Year of each disaster
+    durations: np.ndarray
+        The number of calendar years between Start_Year and End_Year of each disaster
+
+    Returns
+    -------
+    Tuple of the position of the originating disaster and the calendar year for each expanded row
+    """
+    rows_per_disaster = np.maximum(durations.astype(np.int64) + 1, 0)  # End_Year before Start_Year yields no rows
+    first_rows = np.cumsum(rows_per_disaster) - rows_per_disaster
+    row_positions = np.repeat(np.arange(len(rows_per_disaster)), rows_per_disaster)
+    # row number minus the disaster's first row is the offset to its Start_Year
+    expanded_years = (start_years - first_rows)[row_positions] + np.arange(len(row_positions))
+    return row_positions, expanded_years
 
 
 def get_yearly_deaths(df: pd.DataFrame, custom_index: list | None = None, include_zero: bool = True) -> pd.Series:
@@ -89,73 +116,72 @@ def get_yearly_deaths(df: pd.DataFrame, custom_index: list | None = None, includ
     :Authors:
         Moritz Renkin <e11807211@student.tuwien.ac.at>
     """
-    df: pd.DataFrame = df.copy()
+    df: pd.DataFrame = df.loc[:, ["Start_Year", "End_Year", "Total_Deaths"] + (custom_index or [])]
+    df.sort_values("Start_Year", kind="mergesort", inplace=True)
     min_start_year = df["Start_Year"].min()
     max_start_year = df["Start_Year"].max()
 
+    # group string columns by their integer codes and restore the labels at the end
+    custom_index_uniques = {}
+    custom_index_columns = {}
+    for label in custom_index or []:
+        if df[label].dtype == object:
+            codes, custom_index_uniques[label] = pd.factorize(df[label], sort=True)
+            custom_index_columns[label] = np.where(codes == -1, np.NaN, codes) if (codes == -1).any() else codes
+        else:
+            custom_index_columns[label] = df[label].to_numpy()
+
     alternate_cust_idx = ["__CUST_IDX"]
     if custom_index is None:
         custom_index = alternate_cust_idx
-        df[alternate_cust_idx] = 0
-
-    df = df.loc[:, ["Start_Year", "End_Year", "Total_Deaths"] + custom_index]
-    df["Duration_CalendarYears"] = df["End_Year"].subtract(df["Start_Year"], fill_value=0)
-    df.drop("End_Year", axis=1, inplace=True)
-    df["Yearly_Disaster_Deaths"] = df["Total_Deaths"].div(df["Duration_CalendarYears"] + 1, fill_value=np.NaN)
-    df.rename(columns={"Start_Year": "Year"}, inplace=True)
+        custom_index_columns["__CUST_IDX"] = np.zeros(len(df), dtype=np.int64)
+
+    start_years = df["Start_Year"].to_numpy()
+    durations = np.nan_to_num(df["End_Year"].to_numpy() - start_years)
+    total_deaths = df["Total_Deaths"].to_numpy()
+    df = pd.DataFrame({
+        "Year": start_years,
+        "Duration_CalendarYears": durations,
+        "Yearly_Disaster_Deaths": total_deaths / (durations + 1),
+        "Total_Deaths": total_deaths,
+        **custom_index_columns
+    })
 
     index_labels = ["Year"] + custom_index
-    intra_year_disasters = df.loc[df["Duration_CalendarYears"] == 0, ["Total_Deaths"] + index_labels]
-    perennial_disasters = df.loc[df["Duration_CalendarYears"] != 0, ["Yearly_Disaster_Deaths", "Duration_CalendarYears"] + index_labels]
+    is_intra_year = durations == 0
+    intra_year_disasters = df.iloc[is_intra_year, :]
+    perennial_disasters = df.iloc[~is_intra_year, :]
+
+    intra_year_disaster_deaths = intra_year_disasters.groupby(index_labels, sort=False, observed=True)["Total_Deaths"].sum()
 
-    intra_year_disaster_deaths = intra_year_disasters.groupby(index_labels).sum()
-    intra_year_disaster_deaths = intra_year_disaster_deaths.loc[:, "Total_Deaths"]
+    perennial_disasters = perennial_disasters.dropna(axis=0)
+    row_positions, expanded_years = _expand_year_ranges(perennial_disasters["Year"].to_numpy(), perennial_disasters["Duration_CalendarYears"].to_numpy())
+    expanded_deaths = pd.Series(perennial_disasters["Yearly_Disaster_Deaths"].to_numpy()[row_positions], name="Total_Deaths")
+    expanded_keys = [expanded_years] + [perennial_disasters[label].to_numpy()[row_positions] for label in custom_index]
+    perennial_disaster_deaths = expanded_deaths.groupby(expanded_keys, sort=False, observed=True).sum().rename_axis(index_labels)
 
-    deaths_per_year: pd.Series
+    deaths_per_year: pd.Series = pd.concat([intra_year_disaster_deaths, perennial_disaster_deaths]).groupby(level=index_labels).sum()
     if include_zero:
-        custom_index_values = [list(df[label].unique()) for label in custom_index]
+        custom_index_values = [np.sort(df[label].dropna().unique()) for label in custom_index]
         complete_year_range = range(min_start_year, max_start_year + 1)
-        result_index = pd.MultiIndex.from_product(iterables=[complete_year_range]+custom_index_values, names=index_labels).dropna()
-        empty_series = pd.Series(data=0, name="Total_Deaths", index=result_index)
-        deaths_per_year = empty_series.add(intra_year_disaster_deaths, fill_value=0).astype("float32")  # will be filled with perennial disaster_deaths later
-
-    else:
-        deaths_per_year = intra_year_disaster_deaths
-
-    def _flatten_death_distr(year_df: pd.DataFrame) -> None:
-        nonlocal deaths_per_year
-        curr_year = year_df['Year'].iloc[0]
-        year_df.dropna(axis=0, inplace=True)
-        if len(year_df) == 0:
-            return
-
-        yearly_deaths_by_duration: pd.DataFrame = year_df[["Duration_CalendarYears", "Yearly_Disaster_Deaths"] + custom_index]\
-            .groupby(["Duration_CalendarYears"] + custom_index, sort=False).sum()
-
-        duration_df: pd.DataFrame
-        for Duration_CalendarYears, duration_df in yearly_deaths_by_duration.groupby(level="Duration_CalendarYears", sort=False):
-            duration_df.reset_index(inplace=True)
-            duration_df.drop("Duration_CalendarYears", axis=1, inplace=True)
-
-            year_range = np.arange(start=curr_year, stop=curr_year + Duration_CalendarYears + 1)
-            year_idx_array: np.ndarray = np.asarray(year_range).repeat(len(duration_df))
-
-            add_df: pd.DataFrame = pd.concat([duration_df] * len(year_range), ignore_index=True)
-            add_df["Year"] = year_idx_array
-            add_df.set_index(index_labels, inplace=True)
-            add_series: pd.Series = add_df["Yearly_Disaster_Deaths"]
-            add_series.rename("Total_Deaths", inplace=True)
-
-            deaths_per_year = deaths_per_year.add(add_series, fill_value=0)
-
-    perennial_disasters.groupby("Year", as_index=False, sort=False).apply(_flatten_death_distr)
+        result_index = pd.MultiIndex.from_product(iterables=[complete_year_range]+custom_index_values, names=index_labels)
+        # perennial disasters may last beyond the last Start_Year, those years are only kept where deaths occurred
+        is_after_last_start = deaths_per_year.index.get_level_values("Year") > max_start_year
+        deaths_per_year = pd.concat([
+            deaths_per_year.reindex(result_index, fill_value=0.0),
+            deaths_per_year[is_after_last_start]
+        ])
 
     if custom_index == alternate_cust_idx:
-        deaths_per_year.reset_index(level=custom_index, inplace=True, drop=True)
+        deaths_per_year = deaths_per_year.droplevel(custom_index)
+    if custom_index_uniques:
+        labels = list(custom_index_uniques)
+        levels = [uniques.take(deaths_per_year.index.levels[index_labels.index(label)].astype(np.int64)) for label, uniques in custom_index_uniques.items()]
+        deaths_per_year.index = deaths_per_year.index.set_levels(levels, level=labels)
     if not include_zero:
         deaths_per_year = deaths_per_year[deaths_per_year!=0]
 
-    return deaths_per_year.astype(np.float64)
+    return deaths_per_year.astype(np.float64, copy=False)
 
 
 def plot_world_map(merged, title) -> None:
@@ -166,12 +192,8 @@ def plot_world_map(merged, title) -> None:
     merged: pd.DataFrame
         Dataframe merged with coordinates df
     """
-    # Read data to json.
-    merged_json = json.loads(merged.to_json())
-    # Convert to String like object.
-    json_data = json.dumps(merged_json)
     # Input GeoJSON source that contains features for plotting.
-    geosource = GeoJSONDataSource(geojson=json_data)
+    geosource = GeoJSONDataSource(geojson=merged.to_json())
     # Define a sequential multi-hue color palette.
     palette = brewer['YlGnBu'][8]
     # Reverse color order so that dark blue is highest obesity.
@@ -192,6 +214,9 @@ def plot_world_map(merged, title) -> None:
     # Specify figure layout.
     p.add_layout(color_bar, 'below')
     # Display figure inline in Jupyter Notebook.
-    output_notebook()
+    global _notebook_initialized
+    if not _notebook_initialized:
+        output_notebook()
+        _notebook_initialized = True
     # Display figure.
     show(p)